@@ -1,10 +1,8 @@
-import random
 import numpy as np
-import itertools
 import pandas as pd
 
 
-def add_bias(data, antecedent, consequent, positive=True, amount=0.2):
+def add_bias(data, antecedent, consequent, positive=True, amount=0.2, seed=None):
     """Adds some bias in the given dataset, for injecting a certain relationship.
 
     The relationship of interest is the relationship between the variables `antecedent` and `consequent`. In particular, the
@@ -19,7 +17,8 @@ def add_bias(data, antecedent, consequent, positive=True, amount=0.2):
     antecedent : str
         Antecedent feature
     consequent : str
-        Consequent feature
+        Consequent feature. Its values must be spaced by integer steps from its smallest value (e.g. 0, 1, 2 or 0.5, 1.5, 2.5), 
+        since they are changed by one level at a time. Missing values are left unchanged.
     positive : bool, optional
         Positive or negative influence of the antecedent variable on the consequent variable, by default True.
         Positive influence means positive correlation: the bigger `antecedent`, the bigger `consequent`.
@@ -27,6 +26,9 @@ def add_bias(data, antecedent, consequent, positive=True, amount=0.2):
     amount : float, optional
         Amount of bias to inject, by default 0.2.
         Intuitively represents the probability that a value of `consequent` is changed. 
+    seed : int or np.random.Generator, optional
+        Seed of the random number generator, or random number generator itself, by default None.
+        If None, a fresh random number generator is used, seeded from the OS.
 
     Returns
     -------
@@ -40,15 +42,27 @@ def add_bias(data, antecedent, consequent, positive=True, amount=0.2):
     """
     data = data.copy()
 
-    # Sorted support (i.e. set of all the possible values) of the antecedent variable
-    antecedent_support = sorted(data[antecedent].unique())
+    # NumPy arrays of the `antecedent` and `consequent` values
+    antecedent_values = data[antecedent].to_numpy()
+    consequent_values = data[consequent].to_numpy()
+
+    # Sorted support (i.e. set of all the possible values) of the antecedent variable, and position of the `antecedent` value 
+    # of each instance in it
+    sorted_antecedent_support, antecedent_positions = np.unique(antecedent_values, return_inverse=True)
+    antecedent_support = sorted_antecedent_support
     if not positive:  # If we want to enforce a negative influence, we reverse the ordering of support
         antecedent_support = antecedent_support[::-1]
     
+    # Instances with a `consequent` value: the ones with a missing value are left unchanged
+    present = ~pd.isna(consequent_values)
+    if not present.any():
+        return data
+    consequent_values = consequent_values[present]
+    
     # Biggest value of `consequent`
-    max_consequent_value = data[consequent].max()
+    max_consequent_value = consequent_values.max()
     # Smallest value of `consequent`
-    min_consequent_value = data[consequent].min()
+    min_consequent_value = consequent_values.min()
 
     # Now, the idea is to iterate over all `antecedent` values, in the defined order. At each step, we take all the `consequent` 
     # values related to that `antecedent` value and we change them, with some probabilities.
@@ -62,29 +76,110 @@ def add_bias(data, antecedent, consequent, positive=True, amount=0.2):
     # Change of `neg_amount` and `pos_amount` at each step. `neg_amount`: negative change; `pos_amount`: positive change.
     step_amount = amount/(len(antecedent_support)-1)
 
-    # Function which takes in input a `consequent` value and modifies it, according to the current probabilities `neg_amount`
-    # and `neg_amount`.
-    def modify_consequent_value(consequent_value):
-        if random.uniform(0,1)<=neg_amount and consequent_value>min_consequent_value:  # Decrease the value
-            return consequent_value-1
-        elif random.uniform(0,1)<=pos_amount and consequent_value<max_consequent_value:  # Increase the value
-            return consequent_value+1
-        else:  # Keep the value the same
-            return consequent_value 
+    # Rather than changing the `consequent` values step after step, we compute, for each pair (`antecedent` value, starting 
+    # level of `consequent`) occurring in the dataset, the probability that a `consequent` value ends up in each level. Such 
+    # pair is called state. Then, each `consequent` value is changed only once, by sampling from the distribution of its state.
+    # Since each step moves a value by at most one level, after all the steps a value is at most `n_steps` levels away from 
+    # its starting level: the distribution of each state is stored only on these 2*`n_steps`+1 levels, whatever the number 
+    # of levels of `consequent`.
+
+    # Starting level of the `consequent` value of each instance, i.e. number of steps from the smallest value of `consequent`
+    consequent_levels = np.asarray(consequent_values, dtype=float)-float(min_consequent_value)
+    if not np.array_equal(consequent_levels, np.round(consequent_levels)):
+        raise ValueError(f'The values of `consequent` must be spaced by integer steps from its smallest value. '
+                         f'Column: {consequent}')
+    consequent_levels = consequent_levels.astype(np.intp)
+    # Number of `consequent` levels: all the values from the smallest to the biggest value of `consequent`, with step 1
+    n_levels = int(max_consequent_value-min_consequent_value)+1
+
+    # States occurring in the dataset, and state of each instance
+    states_codes, states = np.unique(antecedent_positions[present]*n_levels+consequent_levels, return_inverse=True)
+    # `antecedent` position and starting level of each state
+    states_positions, states_levels = np.divmod(states_codes, n_levels)
+    # Number of steps, and offsets of the levels reachable from the starting level
+    n_steps = len(antecedent_support)
+    offsets = np.arange(-n_steps, n_steps+1)
+    # Reachable levels of each state
+    states_reachable_levels = states_levels[:, np.newaxis]+offsets
+    # Distribution of each state over its reachable levels. At the beginning, all the probability is on the starting level.
+    distributions = np.zeros((len(states_codes), len(offsets)))
+    distributions[:, n_steps] = 1.0
 
     # Iterate over all `antecedent` values, in the defined order.
     # If `positive` is True: from the smallest to the biggest values. Otherwise, from the biggest to the smallest.
     for antecedent_value in antecedent_support:
-        # Apply `modify_consequent_value` to each `consequent` value related to the current `antecedent_value`
-        data.loc[data[antecedent]>=antecedent_value, consequent] = data[consequent][data[antecedent]>=antecedent_value].map(modify_consequent_value)
+        # The current step touches the states whose `antecedent` value is bigger or equal than `antecedent_value`
+        touched = states_positions>=np.searchsorted(sorted_antecedent_support, antecedent_value)
+        reachable_levels = states_reachable_levels[touched]
+        touched_distributions = distributions[touched]
+        # Probabilities of decreasing and increasing each level. A value is decreased only if it is not already the smallest 
+        # one. Otherwise, it can still be increased, if it is not already the biggest one.
+        decrease = np.clip(neg_amount, 0.0, 1.0)*(reachable_levels>0)
+        increase = (1-decrease)*np.clip(pos_amount, 0.0, 1.0)*(reachable_levels<n_levels-1)
+        # New distributions: the probability of each level stays there, or moves to the previous or to the next level
+        new_distributions = touched_distributions*(1-decrease-increase)
+        new_distributions[:, :-1] += (touched_distributions*decrease)[:, 1:]
+        new_distributions[:, 1:] += (touched_distributions*increase)[:, :-1]
+        distributions[touched] = new_distributions
         # Update the probabilities
         neg_amount -= step_amount
         pos_amount += step_amount
+
+    # Cumulative distribution of the final level, for each state. It is set exactly to 1 from the last level with non-zero
+    # probability onwards, so that rounding errors can not give any probability to the levels after it.
+    cumulative_distributions = np.cumsum(distributions, axis=1)
+    n_states, n_offsets = cumulative_distributions.shape
+    last_levels = n_offsets-1-np.argmax(distributions[:, ::-1]>0, axis=1)
+    cumulative_distributions[np.arange(n_offsets)>=last_levels[:, np.newaxis]] = 1.0
+    # We shift the cumulative distribution of each state by the index of the state: in this way, all of them can be 
+    # concatenated into a single sorted array, and the final levels of all the `consequent` values are sampled in a single 
+    # pass, by means of `np.searchsorted`.
+    cumulative_distributions = (cumulative_distributions+np.arange(n_states)[:, np.newaxis]).ravel()
+    # Sample the final level of each `consequent` value. The operations are done in place, for not allocating temporary 
+    # arrays: the uniform draws are shifted by the states, and the final levels are obtained from the positions found in 
+    # `cumulative_distributions` by subtracting the position of the first reachable level of each state.
+    u = np.random.default_rng(seed).random(len(states))
+    u += states
+    # A draw very close to 1 can be rounded up to the next state when shifted: it is kept below the start of the next state
+    np.minimum(u, np.nextafter(states+1.0, -np.inf), out=u)
+    final_levels = np.searchsorted(cumulative_distributions, u, side='right')
+    final_levels -= states*n_offsets
+    final_levels += states_levels[states]-n_steps
+    data.loc[present, consequent] = final_levels+min_consequent_value
     
     return data
 
 
 
+def _encode(data, column):
+    """Encodes the given column of the dataset into integer codes.
+
+    Parameters
+    ----------
+    data : pd.DataFrame
+        Dataset
+    column : str
+        Column to encode
+
+    Returns
+    -------
+    support: list
+        Sorted support (i.e. set of all the possible values) of `column`
+    codes: np.ndarray
+        Code of the value of `column` of each instance, i.e. position of that value in `support`. The codes are stored in the 
+        smallest integer type able to hold them (e.g. int8, for less than 128 possible values). Missing values are not part 
+        of `support`, and their code is -1.
+
+    """
+    # Sorted support and codes are computed together, in a single hashing pass over the values. The codes are then downcast 
+    # to the smallest signed integer type able to hold them.
+    codes, support = pd.factorize(data[column].to_numpy(), sort=True)
+    codes = codes.astype(np.min_scalar_type(-max(len(support), 1)))
+
+    return list(support), codes
+
+
+
 def compute_cpd(data, variable, evidences=None):
     """Computes the CPD of `variable` with respect to the `evidences`, using the given dataset.
 
@@ -110,72 +205,75 @@ def compute_cpd(data, variable, evidences=None):
     In the comments in the code, we denote `variable` as X, with a specific possible value x. And we denote `evidences` as 
     X1,...,Xk, with specific possible values x1, ..., xk.
 
+    The instances with a missing value in `variable` or in any of the `evidences` are not counted, and missing values are not 
+    part of the possible values of the variables.
+
     """
-    # All possible values x of X
-    variable_support = sorted(data[variable].unique())
+    # All possible values x of X, and code of the value of X of each instance, i.e. position of that value in 
+    # `variable_support`
+    variable_support, variable_codes = _encode(data, variable)
     # Number of possible values of X
     m = len(variable_support)
     
-    if evidences is None:
+    if evidences is None or len(evidences) == 0:
         # No evidences: we want to build a simple prior distribution. Only one row, with `m` columns.
-        n = 1  # Number of rows
-        rows_constraints = [[]]  # Only one row, with no constraints
+        counts = np.bincount(variable_codes[variable_codes>=0], minlength=m)
+        cpd_values = (counts/counts.sum())[np.newaxis, :]
+        # Index of the only row
+        index = ['']
     else:
         # We have evidences: we want to build the CPD. `n` rows, which is the number of possible different combinations of 
         # values for X1,...Xk. The number of columns is instead `m`.
 
-        # List containing the constraints corresponding to each row of the CPD. Basically, a constraint is of the form 
-        # X1=x1,...,Xk=xk, where x1,...,xk is the specific combination of values associated to that row.
-        rows_constraints = list(itertools.product(*[sorted(data[evidence].unique()) for evidence in evidences]))
-        n = len(rows_constraints)  # Number of rows
+        # All possible values xi of each Xi, and code of the value of each Xi of each instance
+        evidences_supports, evidences_codes = zip(*[_encode(data, evidence) for evidence in evidences])
+        # All the possible combinations of values x1,...,xk for X1,...,Xk. Each combination is associated to a row of the CPD, 
+        # and it corresponds to the constraint X1=x1,...,Xk=xk.
+        rows_constraints = pd.MultiIndex.from_product(evidences_supports, names=evidences)
+        # Number of rows
+        n = len(rows_constraints)
 
-    # Initiale the CPD to a DataFrame n*m         
-    cpd = pd.DataFrame(np.zeros((n,m)), columns=variable_support)
-    
-    # Index to set to the CPD
-    index = []
-
-    # Iterate across all the rows    
-    for row, row_constraints in enumerate(rows_constraints):
-        # Current new row `row`. Corresponding combination of values: x1,...,xk
-
-        # Index of the current new row
-        idx = ''
-
-        # Copy of the dataset
-        data_supp = data.copy()
-
-        # Now we want to keep in `data_supp` only the instances satisfying all the constraints X1=x1,...,Xk=xk.
-        # We iterate over all constraints Xi=xi, and we enforce that constraint on the dataset.
-        for i,constr in enumerate(row_constraints):
-            # Evidence variable Xi
-            evidence = evidences[i]
-            # Updating `idx`
-            idx += f' {evidence}=={constr} '
-            # Updating `data_supp`, after enforcing the constraint Xi=xi
-            data_supp = data_supp[data_supp[evidence]==constr]
-        
-        # Current new row to add into the CPD.
-        # For each value X=x, we compute P(X=x|X1=x1,...,Xk=xk) by computing the fraction of instances in the current 
-        # `data_supp` s.t. X=x.
-        new_row = [data_supp[variable][data_supp[variable]==variable_value].count()/data_supp[variable].count() 
-                   for variable_value in variable_support]
-        # Add the new row
-        cpd.iloc[row,:] = new_row 
-
-        # Add the index of that row into `index`
-        index.append(idx)
-
-    # Fill eventual missing values  
-    values = {variable_value:cpd.fillna(0.0)[variable_value].mean() for variable_value in variable_support[:-1]}
-    values[variable_support[-1]] = 1-sum([fill for v,fill in values.items()])
-    cpd = cpd.fillna(values)
-        
-    # Set the index to the CPD
-    cpd['Evidences'] = index
-    cpd = cpd.set_index('Evidences')
-    
-    # Set the name of the columns
-    cpd.columns.name = variable
+        # Instances without missing values, i.e. without code -1, in X and in X1,...,Xk. Only these are counted.
+        valid = variable_codes>=0
+        for evidence_codes in evidences_codes:
+            valid &= evidence_codes>=0
+
+        # Row of each instance, i.e. position of its combination x1,...,xk in `rows_constraints`. It is computed from the codes 
+        # of the values of X1,...,Xk, in the same way as the position of an element in a k-dimensional array.
+        rows = np.ravel_multi_index([evidence_codes[valid] for evidence_codes in evidences_codes], 
+                                    [len(evidence_support) for evidence_support in evidences_supports])
+
+        # Contingency table, as a n*m array: for each combination x1,...,xk and for each value X=x, number of instances s.t. 
+        # X=x among the ones satisfying X1=x1,...,Xk=xk. All the counts are computed in a single pass over the instances, by 
+        # counting the pairs (row, value).
+        counts = np.bincount(rows*m+variable_codes[valid], minlength=n*m).reshape(n, m)
+        # Number of instances of each combination x1,...,xk
+        rows_counts = counts.sum(axis=1)
+        # Combinations x1,...,xk which occur in the dataset
+        observed = rows_counts>0
+
+        # Values of the CPD, as a n*m array: for each combination x1,...,xk and for each value X=x, P(X=x|X1=x1,...,Xk=xk).
+        cpd_values = np.empty((n, m))
+        cpd_values[observed] = counts[observed]/rows_counts[observed, np.newaxis]
+        # The combinations which never occur in the dataset are filled directly. Each value X=x is filled with the mean of its 
+        # column, computed considering these rows as 0, except the last one, which is filled with the probability left.
+        fill_values = cpd_values[observed].sum(axis=0)/n
+        fill_values[-1:] = 1-fill_values[:-1].sum()  # Slice, for the case of no possible values of X
+        cpd_values[~observed] = fill_values
+
+        # Index of each row: it is of the form ' X1==x1  X2==x2 ... Xk==xk '
+        # Each term ' Xi==xi ' is formatted only once for each value xi, and then gathered for all the rows by means of the 
+        # codes of `rows_constraints`.
+        index = ''
+        for evidence, evidence_support, evidence_rows_codes in zip(evidences, rows_constraints.levels, rows_constraints.codes):
+            terms = np.array([f' {evidence}=={constr} ' for constr in evidence_support], dtype=object)
+            index = index + terms[evidence_rows_codes]
+        index = list(index)
+
+    # Build the CPD, with the name of the rows and of the columns. The columns take the dtype of the possible values of X 
+    # together with the 'Evidences' label, as they did when that label was a column of the CPD: e.g. object for numeric 
+    # values, string for string values.
+    columns = pd.Index([*variable_support, 'Evidences'], name=variable)[:-1]
+    cpd = pd.DataFrame(cpd_values, index=pd.Index(index, name='Evidences'), columns=columns)
         
     return cpd
\ No newline at end of file